@@ -1,5 +1,5 @@
 import glob
-# Load all models
+import importlib
 from os.path import dirname, basename, isfile
 
 import torch.utils.data
@@ -9,20 +9,42 @@ from source.exceptions.configurationerror import ConfigurationError
 from source.data.JointDataset import JointDataset
 from source.logcreator.logcreator import Logcreator
 
-modules = glob.glob(dirname(__file__) + "/*.py")
-for module in [basename(f)[:-3] for f in modules if
-               isfile(f) and not f.endswith('__init__.py') and not f == "datasetfactory"]:
-    __import__("source.data." + module)
+_datasets_loaded = False
+
+
+def _ensure_datasets_loaded():
+    """
+    Imports all dataset modules (thus registers the JointDataset subclasses) on first use instead of at import time.
+    """
+    global _datasets_loaded
+    if _datasets_loaded:
+        return
+
+    modules = glob.glob(dirname(__file__) + "/*.py")
+    for module in [basename(f)[:-3] for f in modules if
+                   isfile(f) and not f.endswith('__init__.py') and not basename(f) == "datasetfactory.py"]:
+        importlib.import_module("source.data." + module)
+
+    _datasets_loaded = True
+
 
 class DataSetFactory(object):
 
     @staticmethod
     def load(general_cfg, is_train):
+        _ensure_datasets_loaded()
+
         dataset_cfg = general_cfg.dataset
 
         all_datasets = JointDataset.__subclasses__()
         if dataset_cfg:
-            dataset = [m(general_cfg, is_train) for m in all_datasets if m.name.lower() in [dataset.lower() for dataset in dataset_cfg]]
+            wanted = {name.lower() for name in dataset_cfg}
+
+            unknown = wanted - {m.name.lower() for m in all_datasets}
+            if unknown:
+                raise ConfigurationError('data_collection.dataset', ', '.join(sorted(unknown)))
+
+            dataset = [m(general_cfg, is_train) for m in all_datasets if m.name.lower() in wanted]
             if dataset and len(dataset) > 0:
                 return torch.utils.data.ConcatDataset(dataset)
 
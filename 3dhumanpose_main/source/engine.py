@@ -9,12 +9,14 @@ __author__ = 'Andreas Kaufmann, Jona Braun, Kouroche Bouchiat'
 __email__ = "ankaufmann@student.ethz.ch, jonbraun@student.ethz.ch, kbouchiat@student.ethz.ch"
 
 from comet_ml import Experiment
+import copy
 import os
 import sys
 
 import time
 import random
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
 
 import numpy as np
 import torch
@@ -26,7 +28,8 @@ from torchsummary import summary
 from tqdm import tqdm
 
 from source.configuration import Configuration
-from source.helpers.img_utils import trans_coords_from_patch_to_org_3d
+from source.exceptions.configurationerror import ConfigurationError
+from source.helpers.img_utils import trans_coords_from_patch_to_org_3d_batch
 from source.helpers.utils import AverageMeter
 
 from source.logcreator.logcreator import Logcreator
@@ -40,6 +43,11 @@ from source.data.datasetfactory import DataSetFactory
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
+# number of batches between two updates of the loss in the progressbar (each update synchronizes with the gpu)
+PROGRESSBAR_UPDATE_INTERVAL = 20
+# minimal time in seconds between two redraws of the progressbar
+PROGRESSBAR_MININTERVAL = 1.0
+
 
 class Engine:
 
@@ -48,11 +56,39 @@ class Engine:
         seed = 49626446
         self.fix_random_seeds(seed)
 
-        self.model = ModelFactory.build().to(DEVICE)
+        # input patches have a fixed size, let cudnn pick the fastest kernels and allow tf32 on ampere gpus
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        if hasattr(torch.backends.cuda.matmul, 'allow_bf16_reduced_precision_reduction'):  # torch >= 1.12
+            torch.backends.cuda.matmul.allow_bf16_reduced_precision_reduction = True
+
+        # channels last (NHWC) memory format enables the fastest cudnn convolution kernels on tensor cores
+        self.model = ModelFactory.build().to(DEVICE, memory_format=torch.channels_last)
+        # forward passes go through the (optionally) compiled model, self.model stays the plain module for
+        # saving and loading
+        self.compiled_model = self.compile_model(self.model)
         self.optimizer = OptimizerFactory.build(self.model)
         self.lr_scheduler = LRSchedulerFactory.build(self.optimizer)
         self.loss_function = LossFunctionFactory.build(self.model).to(DEVICE)
-        # self.scaler = torch.cuda.amp.GradScaler()  # I assumed we always use gradscaler, thus no factory for this
+
+        # mixed precision is only available on cuda, on cpu autocast and scaler are no-ops
+        self.use_amp = DEVICE == "cuda"
+        # bf16 has the range of fp32 and needs no loss scaling, fp16 is used on gpus without bf16 support
+        self.amp_dtype = torch.bfloat16 if self.use_amp and torch.cuda.is_bf16_supported() else torch.float16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp and self.amp_dtype == torch.float16)
+
+        # converts the model output to joint coordinates in the patch, only depends on the configuration
+        self.result_func = get_result_func()
+        self.patch_width, self.patch_height = Configuration.get("data_collection.image_size")
+
+        # checkpoints are written to disk in the background to not block the training loop
+        self.checkpoint_writer = ThreadPoolExecutor(max_workers=1)
+        self.pending_checkpoints = []
+
+        # datasets are built on first use and reused afterwards (parsing the annotations is expensive)
+        self.train_dataset = None
+        self.valid_dataset = None
 
         # initialize tensorboard logger
         Configuration.tensorboard_folder = os.path.join(Configuration.output_directory, "tensorboard")
@@ -70,6 +106,20 @@ class Engine:
         Logcreator.info("Following device will be used for training: " + DEVICE,
                         torch.cuda.get_device_name(0) if torch.cuda.is_available() else "")
 
+    def compile_model(self, model):
+        """
+        Compiles the model with torch.compile if enabled in the configuration and supported by the torch version.
+        """
+        if not Configuration.get("training.general.compile_model", optional=True, default=False):
+            return model
+
+        if not hasattr(torch, 'compile'):
+            Logcreator.warn("torch.compile is not available in torch", torch.__version__, "- model is not compiled")
+            return model
+
+        # the input shape is fixed, thus no dynamic shapes, reduce-overhead additionally uses cuda graphs
+        return torch.compile(model, mode='reduce-overhead', fullgraph=False, dynamic=False, backend='inductor')
+
     def fix_random_seeds(self, seed):
         torch.manual_seed(seed)
         np.random.seed(seed)
@@ -78,27 +128,41 @@ class Engine:
     def get_lr(self):
         return self.optimizer.param_groups[0]['lr']
 
+    def load_datasets(self):
+        if self.train_dataset is None:
+            self.train_dataset = DataSetFactory.load(Configuration.get('data_collection'),
+                                                     is_train=True)
+
+        if self.valid_dataset is None:
+            self.valid_dataset = DataSetFactory.load(Configuration.get('data_collection'),
+                                                     is_train=False)
+
+        return self.train_dataset, self.valid_dataset
+
     def train(self, epoch_nr=0):
-        train_dataset = DataSetFactory.load(Configuration.get('data_collection'),
-                                            is_train=True)
+        train_dataset, valid_dataset = self.load_datasets()
 
-        valid_dataset = DataSetFactory.load(Configuration.get('data_collection'),
-                                            is_train=False)
+        num_workers = Configuration.get("training.general.num_workers")
+        # keep the workers alive between epochs and prefetch more batches (only possible with worker processes)
+        worker_kwargs = {'persistent_workers': True, 'prefetch_factor': 4} if num_workers > 0 else {}
 
         train_loader = torch.utils.data.DataLoader(
             train_dataset,
             batch_size=Configuration.get("training.general.batch_size"),  # * len(gpus)
             shuffle=Configuration.get("training.general.shuffle_data"),
-            num_workers=Configuration.get("training.general.num_workers"),
-            pin_memory=True
+            num_workers=num_workers,
+            pin_memory=True,
+            drop_last=True,  # every step has the same input shape (no recompilation / new cudnn autotuning)
+            **worker_kwargs
         )
 
         valid_loader = torch.utils.data.DataLoader(
             valid_dataset,
             batch_size=Configuration.get("training.general.batch_size"),  # * len(gpus)
             shuffle=False,
-            num_workers=Configuration.get("training.general.num_workers"),
-            pin_memory=True
+            num_workers=num_workers,
+            pin_memory=True,
+            **worker_kwargs
         )
 
         # Load training parameters from config file
@@ -139,6 +203,8 @@ class Engine:
 
             epoch += 1
 
+        self.wait_for_checkpoints()
+
     def train_step(self, data_loader, epoch):
         """
         Train model for 1 epoch.
@@ -154,7 +220,12 @@ class Engine:
         losses = AverageMeter()
 
         # progressbar
-        loop = tqdm(data_loader, file=sys.stdout, colour='green')
+        loop = tqdm(data_loader, file=sys.stdout, colour='green', mininterval=PROGRESSBAR_MININTERVAL)
+
+        # gradients of several batches can be accumulated before an optimizer step
+        accumulation_steps = Configuration.get("training.general.accumulation_steps", optional=True, default=1)
+        if not isinstance(accumulation_steps, int) or accumulation_steps < 1:
+            raise ConfigurationError('training.general.accumulation_steps', str(accumulation_steps))
 
         end = time.time()
 
@@ -165,37 +236,41 @@ class Engine:
 
             batch_data, batch_label, batch_label_weight, meta = data
 
-            self.optimizer.zero_grad()
+            if batch_idx % accumulation_steps == 0:
+                self.optimizer.zero_grad(set_to_none=True)
 
-            batch_data = batch_data.to(DEVICE)
-            batch_label = batch_label.to(DEVICE)
-            batch_label_weight = batch_label_weight.to(DEVICE)
+            batch_data = batch_data.to(DEVICE, non_blocking=True, memory_format=torch.channels_last)
+            batch_label = batch_label.to(DEVICE, non_blocking=True)
+            batch_label_weight = batch_label_weight.to(DEVICE, non_blocking=True)
 
             batch_size = batch_data.size(0)
 
             # runs the forward pass with autocasting (improve performance while maintaining accuracy)
-            # with torch.cuda.amp.autocast():
-            predictions = self.model(batch_data)
-
-            loss = self.loss_function(predictions, batch_label, batch_label_weight)
+            with torch.autocast(device_type='cuda', dtype=self.amp_dtype, enabled=self.use_amp):
+                predictions = self.compiled_model(batch_data)
+                loss = self.loss_function(predictions, batch_label, batch_label_weight)
             del batch_data, batch_label, batch_label_weight, predictions
 
             # backward according to https://pytorch.org/docs/stable/notes/amp_examples.html#amp-examples
-            if False:  # TODO: do we use scaler?
-                self.scaler.scale(loss).backward()
+            is_optimizer_step = (batch_idx + 1) % accumulation_steps == 0 or batch_idx + 1 == len(data_loader)
+
+            # the last window may hold fewer batches, the loss is averaged over the batches actually accumulated
+            window_start = batch_idx - batch_idx % accumulation_steps
+            window_size = min(accumulation_steps, len(data_loader) - window_start)
+
+            self.scaler.scale(loss / window_size).backward()
+
+            if is_optimizer_step:
                 self.scaler.step(self.optimizer)
                 self.scaler.update()
-            else:
-                self.optimizer.zero_grad()  # TODO: They use it also twice in original code why ?
-                loss.backward()
-                self.optimizer.step()
 
             # update loss
-            # record loss
-            losses.update(loss.item(), batch_size)
+            # record loss (kept on the device to avoid a gpu sync per batch)
+            losses.update(loss.detach(), batch_size)
 
             # update tqdm progressbar
-            loop.set_postfix(loss=loss.item())
+            if batch_idx % PROGRESSBAR_UPDATE_INTERVAL == 0:
+                loop.set_postfix(loss=float(losses.avg), refresh=False)
 
             del loss
 
@@ -220,7 +295,7 @@ class Engine:
 
         loop.close()
 
-        train_loss = losses.avg
+        train_loss = float(losses.avg)
 
         Logcreator.info(f"Training: avg. loss: {train_loss:.5f}")
 
@@ -233,80 +308,63 @@ class Engine:
 
         return train_loss
 
-    def validate(self, data_loader, epoch, only_prediction=False):
+    def validate(self, data_loader, epoch, only_prediction=False, model=None):
         """
         Evaluate model on validation data.
+
+        An inference-only variant of the model (e.g. frozen by the prediction) can be passed with model.
         """
         print("Validation step")
         self.model.eval()
-
-        result_func = get_result_func()
+        if model is None:
+            model = self.compiled_model
 
         losses = AverageMeter()
 
         # initialize the progressbar
-        loop = tqdm(data_loader, file=sys.stdout, colour='green')
+        loop = tqdm(data_loader, file=sys.stdout, colour='green', mininterval=PROGRESSBAR_MININTERVAL)
 
         preds_in_patch_with_score = []
-        with torch.no_grad():
+        with torch.inference_mode():
             for i, data in enumerate(loop):
                 batch_data, batch_label, batch_label_weight, meta = data
 
-                batch_data = batch_data.cuda()
-                batch_label = batch_label.cuda()
-                batch_label_weight = batch_label_weight.cuda()
+                batch_data = batch_data.to(DEVICE, non_blocking=True, memory_format=torch.channels_last)
+                batch_label = batch_label.to(DEVICE, non_blocking=True)
+                batch_label_weight = batch_label_weight.to(DEVICE, non_blocking=True)
 
                 batch_size = batch_data.size(0)
 
                 # compute output
-                predictions = self.model(batch_data)
+                with torch.autocast(device_type='cuda', dtype=self.amp_dtype, enabled=self.use_amp):
+                    predictions = model(batch_data)
 
                 if not only_prediction:
                     loss = self.loss_function(predictions, batch_label, batch_label_weight)
 
-                    # update loss
-                    losses.update(loss.item(), batch_size)
+                    # update loss (kept on the device to avoid a gpu sync per batch)
+                    losses.update(loss.detach(), batch_size)
 
                     # update tqdm progressbar
-                    loop.set_postfix(loss=loss.item())
+                    if i % PROGRESSBAR_UPDATE_INTERVAL == 0:
+                        loop.set_postfix(loss=float(losses.avg), refresh=False)
 
                     del loss
 
                 del batch_data, batch_label, batch_label_weight
 
-                preds_in_patch_with_score.append(result_func(patch_width=256, patch_height=256,
-                                                             preds=predictions))  # TODO understand result_func and maybe refactor it
+                preds_in_patch_with_score.append(self.result_func(patch_width=self.patch_width,
+                                                                  patch_height=self.patch_height,
+                                                                  preds=predictions))  # TODO understand result_func and maybe refactor it
                 del predictions
 
             loop.close()
 
-            # TODO This line causes "VisibleDeprecationWarning" (see TODO below)
-            _p = np.asarray(preds_in_patch_with_score)
+            # concatenate the batches on the device (handles a partial last batch) and copy to the cpu once
+            preds_in_patch_with_score = torch.cat(preds_in_patch_with_score, dim=0)
+            preds_in_patch_with_score = preds_in_patch_with_score[0: len(data_loader.dataset)].cpu().numpy()
 
-            # Dirty solution for partial batches
-            if len(_p.shape) < 2:
-                tp = np.zeros(((_p.shape[0] - 1) * _p[0].shape[0] + _p[-1].shape[0], _p[0].shape[1], _p[0].shape[2]))
-
-                start = 0
-                end = _p[0].shape[0]
-
-                for t in _p:
-                    tp[start:end] = t
-                    start = end
-                    end += t.shape[0]
-
-                _p = tp
-            else:
-                _p = _p.reshape((_p.shape[0] * _p.shape[1], _p.shape[2], _p.shape[3]))
-
-            # TODO Understand how we use preds_in_patch_with_score and why code above is needed or not needed
-            #  Following code with np.vstack works, as a replacement of all the code above (but does it work in every case?):
-            # _test = np.vstack(preds_in_patch_with_score)
-            # assert(np.equal(_test, _p[0: len(data_loader.dataset)]).all())
-
-            preds_in_patch_with_score = _p[0: len(data_loader.dataset)]
-
-            val_loss = losses.avg
+            val_loss = float(losses.avg)
 
             if not only_prediction:
                 Logcreator.info(f"Validation: avg. loss: {val_loss:.5f}")
@@ -328,19 +386,16 @@ class Engine:
                 imdb = image_set
 
                 # From patch to original image coordinate system
-                preds_in_img_with_score = []
-
-                for n_sample in range(len(image_set)):
-                    # TODO we not neccessaraly pick the "preds_in_patch_with_score[n_sample]" of the h36m set (could also be the mpii),
-                    #  it depends on the order of the paramter "dataset" : ["h36m", "mpii"] in the config file
-                    preds_in_img_with_score.append(
-                        trans_coords_from_patch_to_org_3d(preds_in_patch_with_score[n_sample],
-                                                          imdb_list[n_sample]['center_x'],
-                                                          imdb_list[n_sample]['center_y'], imdb_list[n_sample]['width'],
-                                                          imdb_list[n_sample]['height'], 256, 256,
-                                                          2000, 2000))
-
-                preds_in_img_with_score = np.asarray(preds_in_img_with_score)
+                # TODO we not neccessaraly pick the "preds_in_patch_with_score[n_sample]" of the h36m set (could also be the mpii),
+                #  it depends on the order of the paramter "dataset" : ["h36m", "mpii"] in the config file
+                n_samples = len(image_set)
+                samples = imdb_list[0: n_samples]
+                preds_in_img_with_score = trans_coords_from_patch_to_org_3d_batch(
+                    preds_in_patch_with_score[0: n_samples],
+                    [sample['center_x'] for sample in samples], [sample['center_y'] for sample in samples],
+                    [sample['width'] for sample in samples], [sample['height'] for sample in samples],
+                    self.patch_width, self.patch_height,
+                    2000, 2000)
 
                 # Evaluate
                 if 'joints_3d' in imdb.db[0].keys():
@@ -370,21 +425,76 @@ class Engine:
         if not os.path.exists(Configuration.model_save_folder):
             os.makedirs(Configuration.model_save_folder)
         file_name = str(epoch_nr) + "_whole_model_serialized.pth"
-        torch.save(self.model, os.path.join(Configuration.model_save_folder, file_name))
+        # serialize on the main thread (the model keeps training), only the file is written in the background
+        buffer = BytesIO()
+        torch.save(self.model, buffer)
+        self.write_checkpoint_async(buffer.getvalue(), os.path.join(Configuration.model_save_folder, file_name))
 
     def save_checkpoint(self, epoch, tl, vl):
         Configuration.weights_save_folder = os.path.join(Configuration.output_directory, "weights_checkpoint")
         if not os.path.exists(Configuration.weights_save_folder):
             os.makedirs(Configuration.weights_save_folder)
         file_name = str(epoch) + "_checkpoint.pth"
-        torch.save({
+        # copy the states to the cpu on the main thread, thus they are not modified by the next epoch while saving
+        checkpoint = Engine.copy_to_cpu({
             'epoch': epoch,
             'model_state_dict': self.model.state_dict(),
             'optimizer_state_dict': self.optimizer.state_dict(),
             'lr_scheduler_state_dict': self.lr_scheduler.state_dict(),
             'train_loss': tl,
             'val_loss': vl,
-        }, os.path.join(Configuration.weights_save_folder, file_name))
+        })
+        self.write_checkpoint_async(checkpoint, os.path.join(Configuration.weights_save_folder, file_name))
+
+    def write_checkpoint_async(self, obj, path):
+        """
+        Writes obj to path in a background thread. Bytes are written as they are, everything else with torch.save.
+        Raises the exception of an earlier write that failed in the meantime.
+        """
+        # surface failed writes early and drop the finished ones
+        pending = []
+        for future in self.pending_checkpoints:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self.pending_checkpoints = pending
+
+        if isinstance(obj, bytes):
+            future = self.checkpoint_writer.submit(Engine.write_bytes, obj, path)
+        else:
+            future = self.checkpoint_writer.submit(torch.save, obj, path)
+        self.pending_checkpoints.append(future)
+
+    def wait_for_checkpoints(self):
+        """
+        Blocks until all checkpoints are written, raises the exception of a failed write.
+        """
+        for future in self.pending_checkpoints:
+            future.result()
+        self.pending_checkpoints = []
+
+    @staticmethod
+    def write_bytes(data, path):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    @staticmethod
+    def copy_to_cpu(obj):
+        """
+        Recursively copies all tensors of a (nested) state dict to the cpu. Dicts keep their type and attributes (e.g.
+        the _metadata of an OrderedDict state dict or the Counter of MultiStepLR milestones).
+        """
+        if torch.is_tensor(obj):
+            return obj.detach().to('cpu', copy=True)
+        if isinstance(obj, dict):
+            out = copy.copy(obj)
+            for k in out:
+                out[k] = Engine.copy_to_cpu(out[k])
+            return out
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(Engine.copy_to_cpu(v) for v in obj)
+        return copy.deepcopy(obj)
 
     def load_checkpoints(self, path=None):
         Logcreator.info("Loading checkpoint file:", path)
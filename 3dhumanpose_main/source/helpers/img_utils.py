@@ -102,6 +102,32 @@ def trans_coords_from_patch_to_org_3d(coords_in_patch, c_x, c_y, bb_width, bb_he
     return res_img
 
 
+def trans_coords_from_patch_to_org_3d_batch(coords_in_patch, c_x, c_y, bb_width, bb_height, patch_width, patch_height,
+                                            rect_3d_width, rect_3d_height):
+    """
+    Batched version of trans_coords_from_patch_to_org_3d.
+
+    Without scale and rotation the inverse patch transform is a per-sample scaling and translation, thus it is applied
+    to all samples at once with broadcasting.
+
+    Args:
+        coords_in_patch: coordinates in the patch of shape (N, J, >=3)
+        c_x, c_y, bb_width, bb_height: bounding boxes of the samples, each of shape (N,)
+
+    Returns: coordinates in the original image of shape (N, J, >=3)
+    """
+    c_x = np.asarray(c_x, dtype=float).reshape(-1, 1)
+    c_y = np.asarray(c_y, dtype=float).reshape(-1, 1)
+    bb_width = np.asarray(bb_width, dtype=float).reshape(-1, 1)
+    bb_height = np.asarray(bb_height, dtype=float).reshape(-1, 1)
+
+    coords_in_org = coords_in_patch.copy()
+    coords_in_org[:, :, 0] = c_x + (coords_in_patch[:, :, 0] - patch_width * 0.5) * bb_width / patch_width
+    coords_in_org[:, :, 1] = c_y + (coords_in_patch[:, :, 1] - patch_height * 0.5) * bb_height / patch_height
+    coords_in_org[:, :, 2] = coords_in_patch[:, :, 2] / patch_width * rect_3d_width
+    return coords_in_org
+
+
 def get_single_patch_sample(img_path, center_x, center_y, width, height,
                             patch_width, patch_height,
                             rect_3d_width, rect_3d_height, mean, std,
@@ -8,12 +8,9 @@ def generate_3d_integral_preds_tensor(heatmaps, num_joints, x_dim, y_dim, z_dim)
 
     heatmaps = heatmaps.reshape((heatmaps.shape[0], num_joints, z_dim, y_dim, x_dim))
 
-    accu_x = heatmaps.sum(dim=2)
-    accu_x = accu_x.sum(dim=2)
-    accu_y = heatmaps.sum(dim=2)
-    accu_y = accu_y.sum(dim=3)
-    accu_z = heatmaps.sum(dim=3)
-    accu_z = accu_z.sum(dim=3)
+    accu_x = heatmaps.sum(dim=(2, 3))
+    accu_y = heatmaps.sum(dim=(2, 4))
+    accu_z = heatmaps.sum(dim=(3, 4))
 
     accu_x = accu_x * \
              torch.cuda.comm.broadcast(torch.arange(x_dim).type(torch.cuda.FloatTensor), devices=[accu_x.device.index])[
@@ -5,6 +5,24 @@ import torch.nn as nn
 import math
 
 
+# scripted to let the fuser merge the elementwise ops with the reduction
+@torch.jit.script
+def weighted_l1_loss(input: torch.Tensor, target: torch.Tensor, weights: torch.Tensor, size_average: bool,
+                     norm: bool = False) -> torch.Tensor:
+    if norm:
+        # l1 norm of the flattened tensors
+        input = input / input.abs().sum()
+        target = target / target.abs().sum()
+
+    out = torch.abs(input - target)
+    out = out * weights
+    if size_average:
+        num_valid = weights.byte().any(dim=1).float().sum()
+        return out.sum() / num_valid
+    else:
+        return out.sum()
+
+
 class L1JointRegressionLoss_eth_code(nn.Module):
     def __init__(self, num_joints, size_average=True, reduce=True, norm=False):
         super(L1JointRegressionLoss_eth_code, self).__init__()
@@ -13,20 +31,6 @@ class L1JointRegressionLoss_eth_code(nn.Module):
         self.num_joints = num_joints
         self.norm = norm
 
-    def weighted_l1_loss(self, input, target, weights, size_average, norm=False):
-
-        if norm:
-            input = input / torch.norm(input, 1)
-            target = target / torch.norm(target, 1)
-
-        out = torch.abs(input - target)
-        out = out * weights
-        if size_average:
-            num_valid = weights.byte().any(dim=1).float().sum()
-            return out.sum() / num_valid
-        else:
-            return out.sum()
-
     def _assert_no_grad(self, tensor):
         assert not tensor.requires_grad, \
             "nn criterions don't compute the gradient w.r.t. targets - please " \
@@ -40,7 +44,7 @@ class L1JointRegressionLoss_eth_code(nn.Module):
 
         self._assert_no_grad(gt_joints)
         self._assert_no_grad(gt_joints_vis)
-        return self.weighted_l1_loss(pred_jts, gt_joints, gt_joints_vis, self.size_average, self.norm)
+        return weighted_l1_loss(pred_jts, gt_joints, gt_joints_vis, self.size_average, self.norm)
 
 
 class L1JointRegressionLoss(torch.nn.Module):
@@ -49,12 +53,12 @@ class L1JointRegressionLoss(torch.nn.Module):
 
     @staticmethod
     def regression_loss_2d(pred_joints, gt_joints, gt_joints_vis):
-        error = abs(pred_joints[:, :2] - gt_joints) * gt_joints_vis
+        error = abs(pred_joints[..., :2] - gt_joints) * gt_joints_vis.unsqueeze(-1)
         return torch.sum(error)
 
     @staticmethod
     def regression_loss_3d(pred_joints, gt_joints, gt_joints_vis):
-        error = abs(pred_joints - gt_joints) * gt_joints_vis
+        error = abs(pred_joints - gt_joints) * gt_joints_vis.unsqueeze(-1)
         return torch.sum(error)
 
     def forward(self, preds, batch_joints, batch_joints_vis):
@@ -63,27 +67,22 @@ class L1JointRegressionLoss(torch.nn.Module):
         assert len(batch_joints) == len(batch_joints_vis) == N, \
             f'Batch size mismatch: {N=}, {len(batch_joints)=}, {len(batch_joints_vis)=}'
 
-        batch_losses = []
-        for batch_idx in range(N):
-            gt_joints = batch_joints[batch_idx]
-            gt_joints_vis = batch_joints_vis[batch_idx]
-
-            assert gt_joints_vis.shape == (J,), \
-                f'Invalid shape for batch_joints_vis[{batch_idx}]: expected (J,)' \
-                f'where {J=} but actual {gt_joints_vis.shape}'
-
-            if gt_joints.shape == (J, 2):
-                batch_losses.append(
-                    self.regression_loss_2d(preds[batch_idx], gt_joints, gt_joints_vis, self.sigma)
-                )
-            elif gt_joints.shape == (J, 3):
-                batch_losses.append(
-                    self.regression_loss_3d(preds[batch_idx], gt_joints, gt_joints_vis, self.sigma)
-                )
-            else:
-                raise AssertionError(
-                    f'Invalid shape for batch_joints[{batch_idx}]: expected (J, 2) or (J, 3) '
-                    f'where {J=} but actual {gt_joints.shape}'
-                )
-
-        return torch.cat(batch_losses).sum()
\ No newline at end of file
+        # ground truth is either 2d or 3d for the whole batch, thus the loss is computed on all samples at once
+        if not torch.is_tensor(batch_joints):
+            batch_joints = torch.stack(list(batch_joints))
+        if not torch.is_tensor(batch_joints_vis):
+            batch_joints_vis = torch.stack(list(batch_joints_vis))
+
+        assert batch_joints_vis.shape == (N, J), \
+            f'Invalid shape for batch_joints_vis: expected (N, J) ' \
+            f'where {N=}, {J=} but actual {batch_joints_vis.shape}'
+
+        if batch_joints.shape == (N, J, 2):
+            return self.regression_loss_2d(preds, batch_joints, batch_joints_vis)
+        elif batch_joints.shape == (N, J, 3):
+            return self.regression_loss_3d(preds, batch_joints, batch_joints_vis)
+        else:
+            raise AssertionError(
+                f'Invalid shape for batch_joints: expected (N, J, 2) or (N, J, 3) '
+                f'where {N=}, {J=} but actual {batch_joints.shape}'
+            )
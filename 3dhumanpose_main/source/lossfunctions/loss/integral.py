@@ -1,6 +1,6 @@
-import numpy as np
 from easydict import EasyDict as edict
 
+import torch
 import torch.nn as nn
 
 from ..common_loss.weighted_mse import weighted_l1_loss, weighted_mse_loss
@@ -113,17 +113,17 @@ def get_joint_location_result(config, patch_width, patch_height, preds):
         num_joints = preds.shape[1]
 
     pred_jts = softmax_integral_tensor(preds, num_joints, config.output_3d, hm_width, hm_height, hm_depth)
-    coords = pred_jts.detach().cpu().numpy()
-    coords = coords.astype(float)
+    # stay on the device of the predictions, the caller concatenates all batches and copies them to the cpu once
+    coords = pred_jts.detach().double()
     coords = coords.reshape((coords.shape[0], int(coords.shape[1] / 3), 3))
     # project to original image size
     coords[:, :, 0] = (coords[:, :, 0] + 0.5) * patch_width
     coords[:, :, 1] = (coords[:, :, 1] + 0.5) * patch_height
     coords[:, :, 2] = coords[:, :, 2] * patch_width
-    scores = np.ones((coords.shape[0], coords.shape[1], 1), dtype=float)
+    scores = torch.ones((coords.shape[0], coords.shape[1], 1), dtype=coords.dtype, device=coords.device)
 
     # add score to last dimension
-    coords = np.concatenate((coords, scores), axis=2)
+    coords = torch.cat((coords, scores), dim=2)
 
     return coords
 
@@ -1,6 +1,6 @@
 from functools import partial
 
-import numpy as np
+import torch
 
 from source.configuration import Configuration
 from source.lossfunctions.loss import integral
@@ -19,17 +19,16 @@ def generate_joint_location_label(patch_width, patch_height, joints, joints_vis)
 def get_joint_regression_result(patch_width, patch_height, preds):
     num_joints = preds.shape[1] // 3
 
-    coords = preds.detach().cpu().numpy()
-    coords = coords.astype(float)
+    coords = preds.detach().double()
     coords = coords.reshape((coords.shape[0], coords.shape[1] // 3, 3))
     # project to original image size
     coords[:, :, 0] = (coords[:, :, 0] + 0.5) * patch_width
     coords[:, :, 1] = (coords[:, :, 1] + 0.5) * patch_height
     coords[:, :, 2] = coords[:, :, 2] * patch_width
-    scores = np.ones((coords.shape[0], coords.shape[1], 1), dtype=float)
+    scores = torch.ones((coords.shape[0], coords.shape[1], 1), dtype=coords.dtype, device=coords.device)
 
     # add score to last dimension
-    coords = np.concatenate((coords, scores), axis=2)
+    coords = torch.cat((coords, scores), dim=2)
 
     return coords
 
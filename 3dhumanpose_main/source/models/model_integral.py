@@ -1,5 +1,4 @@
 import torch
-import torch.nn.functional as F
 import torchvision
 
 from source.models.basemodel import BaseModel
@@ -56,35 +55,73 @@ class JointHeatmapDeconv2x(torch.nn.Sequential):
 class JointHeatmapUpsample2x(torch.nn.Sequential):
     def __init__(self, in_channels, out_channels):
         super().__init__(
-            torch.nn.Upsample(scale_factor=2, mode='bilinear'),
+            torch.nn.Upsample(scale_factor=2, mode='bilinear', align_corners=False),
             torch.nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1, bias=False),
             torch.nn.BatchNorm2d(out_channels),
             torch.nn.ReLU(inplace=True)
         )
 
 
+# Alternative to Deconv2x layer: dense 3x3 convolution to 4x the channels followed by a sub-pixel shuffle
+# (same 2x upsampling without the sparse writes and checkerboard artifacts of the transposed convolution)
+class JointHeatmapPixelShuffle2x(torch.nn.Sequential):
+    upscale_factor = 2
+
+    def __init__(self, in_channels, out_channels):
+        super().__init__(
+            torch.nn.Conv2d(in_channels, out_channels * self.upscale_factor ** 2, kernel_size=3, padding=1,
+                            bias=False),
+            torch.nn.PixelShuffle(self.upscale_factor),
+            torch.nn.BatchNorm2d(out_channels),
+            torch.nn.ReLU(inplace=True)
+        )
+
+    def init_icnr(self, std):
+        """
+        ICNR initialization: all sub-pixels of an output channel start with the same kernel, thus the initial
+        upsampling is a nearest neighbour upsampling without checkerboard artifacts.
+        """
+        conv = self[0]
+        sub_kernel = torch.empty(conv.out_channels // self.upscale_factor ** 2, *conv.weight.shape[1:])
+        torch.nn.init.normal_(sub_kernel, mean=0, std=std)
+        with torch.no_grad():
+            conv.weight.copy_(sub_kernel.repeat_interleave(self.upscale_factor ** 2, dim=0))
+
+
 class JointHeatmapDecoder(torch.nn.Module):
-    def __init__(self, in_channels, num_layers, num_filters, kernel_size, num_joints, depth_dim):
+    def __init__(self, in_channels, num_layers, num_filters, kernel_size, num_joints, depth_dim,
+                 upsample_type='deconv'):
         super().__init__()
         self.num_joints = num_joints
         self.depth_dim = depth_dim
 
-        # TODO: Add configurable Upsample2x as an alternative to Deconv2x?
         upsample_module_list = []
         for i in range(num_layers):
-            upsample_module_list.append(JointHeatmapDeconv2x(in_channels=in_channels if i == 0 else num_filters,
-                                  out_channels=num_filters, kernel_size=kernel_size))
+            upsample_module_list.append(self.resolve_upsample_module(upsample_type,
+                                                                     in_channels=in_channels if i == 0 else num_filters,
+                                                                     out_channels=num_filters,
+                                                                     kernel_size=kernel_size))
         self.upsample_features = torch.nn.Sequential(*upsample_module_list)
         # TODO: Add configurable "non-bias" end? (see `with_bias_end' in deconv_head.py)
         self.features_to_heatmaps = torch.nn.Conv2d(num_filters, num_joints * depth_dim, kernel_size=1)
 
-        JointHeatmapDecoder._init_weights(self)
+        self.apply(JointHeatmapDecoder._init_leaf)
+
+    @staticmethod
+    def resolve_upsample_module(name, in_channels, out_channels, kernel_size):
+        if name == 'deconv':
+            return JointHeatmapDeconv2x(in_channels, out_channels, kernel_size)
+        elif name == 'upsample':
+            return JointHeatmapUpsample2x(in_channels, out_channels)
+        elif name == 'pixelshuffle':
+            return JointHeatmapPixelShuffle2x(in_channels, out_channels)
+        raise ValueError(f'Unknown upsample type {name}, expected deconv, upsample or pixelshuffle')
 
     @staticmethod
-    def _init_weights(module):
+    def _init_leaf(module):
         if isinstance(module, torch.nn.Conv2d):
             torch.nn.init.normal_(module.weight, mean=0, std=0.001)
-            if hasattr(module, 'bias'):
+            if module.bias is not None:
                 torch.nn.init.constant_(module.bias, 0)
 
         elif isinstance(module, torch.nn.BatchNorm2d):
@@ -94,9 +131,9 @@ class JointHeatmapDecoder(torch.nn.Module):
         elif isinstance(module, torch.nn.ConvTranspose2d):
             torch.nn.init.normal_(module.weight, mean=0, std=0.001)
 
-        elif isinstance(module, torch.nn.Module):
-            for m in module.children():
-                JointHeatmapDecoder._init_weights(m)
+        elif isinstance(module, JointHeatmapPixelShuffle2x):
+            # apply() visits the children first, thus this overrides the initialization of the conv
+            module.init_icnr(std=0.001)
 
     def forward(self, features):
         features = self.upsample_features(features)
@@ -107,29 +144,58 @@ class JointHeatmapDecoder(torch.nn.Module):
         return heatmaps  # Return format N, J, D, H, W
 
 
+# scripted to let the fuser merge the elementwise ops with the reduction
+@torch.jit.script
+def integrate_heatmaps(heatmaps: torch.Tensor, integral_weights: torch.Tensor) -> torch.Tensor:
+    """
+    Unnormalized softmax of the flattened heatmaps (N, J, K) integrated against the weights (K, 4) in one reduction.
+    A broadcast multiply and sum is used instead of a matmul, as matmuls may run in tf32 (allow_tf32 is enabled in the
+    engine). Unless the fuser merges it with the sum, the product is materialized with 4x the size of the heatmaps.
+
+    Returns: integrals of shape (N, J, 4)
+    """
+    # the max is subtracted before exp to avoid an overflow
+    heatmaps = (heatmaps - heatmaps.amax(dim=-1, keepdim=True)).exp()
+    return (heatmaps.unsqueeze(-1) * integral_weights).sum(dim=-2)
+
+
 class JointIntegralRegressor(torch.nn.Module):
     def __init__(self):
         super().__init__()
 
+    @staticmethod
+    def build_integral_weights(depth_dim: int, height: int, width: int, device: torch.device) -> torch.Tensor:
+        """
+        Weights for the heatmap positions (flattened in D, H, W order): the recentered x, y and z coordinate and a
+        column of ones for the softmax normalizer. Created on the device of the heatmaps (no host allocation and copy
+        per forward pass).
+
+        Returns: weights of shape (D * H * W, 4)
+
+        """
+        x = torch.arange(width, dtype=torch.float32, device=device) / width - 0.5
+        y = torch.arange(height, dtype=torch.float32, device=device) / height - 0.5
+        z = torch.arange(depth_dim, dtype=torch.float32, device=device) / depth_dim - 0.5
+
+        x = x.expand(depth_dim, height, width)
+        y = y.reshape(height, 1).expand(depth_dim, height, width)
+        z = z.reshape(depth_dim, 1, 1).expand(depth_dim, height, width)
+        return torch.stack((x, y, z, torch.ones_like(x)), dim=-1).reshape(depth_dim * height * width, 4)
+
     def forward(self, heatmaps):
         N, J, D, H, W = heatmaps.shape
+        integral_weights = self.build_integral_weights(D, H, W, heatmaps.device)
 
-        # Apply global softmax to the heatmaps
-        heatmaps = heatmaps.reshape(N, J, D * H * W)
-        heatmaps = F.softmax(heatmaps)
-        heatmaps = heatmaps.reshape(N, J, D, H, W)
+        # The softmax and the integral are numerically sensitive, thus they are computed in fp32 even under autocast
+        with torch.cuda.amp.autocast(enabled=False):
+            heatmaps = heatmaps.float().reshape(N, J, D * H * W)
 
-        # Integrate over other axes
-        x_maps = heatmaps.sum(dim=2).sum(dim=2)
-        y_maps = heatmaps.sum(dim=2).sum(dim=3)
-        z_maps = heatmaps.sum(dim=3).sum(dim=3)
+            # Weighted sums of the recentered coordinates and the softmax normalizer in a single reduction, the
+            # normalization is deferred to the (N, J) expectations instead of dividing all D * H * W probabilities
+            integrals = integrate_heatmaps(heatmaps, integral_weights)
 
-        # Take expected coordinate for each axis (and recenter)
-        x_preds = (x_maps * torch.arange(W)).sum(dim=2) / W - 0.5
-        y_preds = (y_maps * torch.arange(H)).sum(dim=2) / H - 0.5
-        z_preds = (z_maps * torch.arange(D)).sum(dim=2) / D - 0.5
-
-        return torch.stack((x_preds, y_preds, z_preds), dim=2)  # Return format N, J, 3
+            # Take expected coordinate for each axis
+            return integrals[:, :, :3] / integrals[:, :, 3:]  # Return format N, J, 3
 
 
 # TODO: Investigate DSAC-like argmax as an alternative to the integral (soft-argmax)
@@ -143,9 +209,6 @@ class ModelIntegralPoseRegression(BaseModel):
     def __init__(self, model_params, dataset_params):
         super().__init__()
         resnet_params = getattr(model_params, str(model_params.resnet_model) + "_params")
-        dataset_specific_params = []
-        for dataset in range(len(dataset_params.dataset)):
-            dataset_specific_params.append(getattr(dataset_params, str(dataset_params.dataset[dataset]) + "_params"))
 
         NUM_JOINTS = 18  # ToDo: What do we input here? Especially if we train with different datasets??
 
@@ -156,12 +219,18 @@ class ModelIntegralPoseRegression(BaseModel):
                                                  num_filters=model_params.num_deconv_filters,
                                                  kernel_size=model_params.kernel_size,
                                                  num_joints=NUM_JOINTS,
-                                                 depth_dim=model_params.depth_dim
+                                                 depth_dim=model_params.depth_dim,
+                                                 upsample_type=getattr(model_params, 'upsample_type', 'deconv')
                                                  )
         self.joint_regressor = JointIntegralRegressor()
+
+        # backbone and decoder are conv only, channels last (NHWC) layout enables the fastest cudnn kernels
+        self.backbone = self.backbone.to(memory_format=torch.channels_last)
+        self.joint_decoder = self.joint_decoder.to(memory_format=torch.channels_last)
         Logcreator.info("Successfully initialized model with name IntegralPoseRegressionModel successfully initialized")
 
     def forward(self, input):
+        input = input.contiguous(memory_format=torch.channels_last)  # no-op if the input is already channels last
         features = self.backbone(input)
         heatmaps = self.joint_decoder(features)
         joints = self.joint_regressor(heatmaps)
@@ -8,9 +8,17 @@ Builds an optimizer from configuration.
 __author__ = 'Andreas Kaufmann, Jona Braun, Kouroche Bouchiat'
 __email__ = "ankaufmann@student.ethz.ch, jonbraun@student.ethz.ch, kbouchiat@student.ethz.ch"
 
+import inspect
+
 import torch.optim as optim
 from source.configuration import Configuration
 
+try:
+    # torch 1.7 - 1.12 ship the multi-tensor optimizers as separate classes
+    import torch.optim._multi_tensor as _multi_tensor
+except ImportError:
+    _multi_tensor = None
+
 
 class OptimizerFactory(object):
     model = False
@@ -22,10 +30,30 @@ class OptimizerFactory(object):
         return getattr(OptimizerFactory, optimizer_cfg.name)(OptimizerFactory, optimizer_cfg)
 
     def adam(self, cfg):
-        return optim.Adam(self.model.parameters(), lr=cfg.lr, betas=(cfg.beta1, cfg.beta2))
+        optimizer_class, kwargs = self.get_multi_tensor_optimizer(self, 'Adam')
+        return optimizer_class(self.model.parameters(), lr=cfg.lr, betas=(cfg.beta1, cfg.beta2), **kwargs)
 
     def sdg(self, cfg):
-        return optim.SDG(self.model.parameters(), lr=cfg.lr, momentum=cfg.momentum, weight_decay=cfg.wd, nesterov=cfg.nesterov)
+        optimizer_class, kwargs = self.get_multi_tensor_optimizer(self, 'SGD')
+        return optimizer_class(self.model.parameters(), lr=cfg.lr, momentum=cfg.momentum, weight_decay=cfg.wd,
+                               nesterov=cfg.nesterov, **kwargs)
+
+    def get_multi_tensor_optimizer(self, name):
+        """
+        The multi-tensor implementation updates all parameters with a few foreach kernels instead of one kernel per
+        parameter. It is selected with foreach=True from torch 1.12 on (the default for cuda parameters from 2.0 on),
+        before it is a separate class in torch.optim._multi_tensor. Only used for cuda parameters.
+
+        Returns: optimizer class and the additional keyword arguments for it
+        """
+        optimizer_class = getattr(optim, name)
+        if not all(p.is_cuda for p in self.model.parameters()):
+            return optimizer_class, {}
+        if 'foreach' in inspect.signature(optimizer_class).parameters:
+            return optimizer_class, {'foreach': True}
+        if _multi_tensor is not None and hasattr(_multi_tensor, name):
+            return getattr(_multi_tensor, name), {}
+        return optimizer_class, {}
 
     @staticmethod
     def get_members():
@@ -8,11 +8,14 @@ Class for prediction of a set of images
 __author__ = 'Andreas Kaufmann, Jona Braun, Kouroche Bouchiat'
 __email__ = "ankaufmann@student.ethz.ch, jonbraun@student.ethz.ch, kbouchiat@student.ethz.ch"
 
+import os
+
 import torch
 from torch.utils.data import DataLoader
 
 from source.configuration import Configuration
 from source.data.datasetfactory import DataSetFactory
+from source.logcreator.logcreator import Logcreator
 
 
 class AttrWrapper(object):
@@ -27,6 +30,43 @@ class AttrWrapper(object):
         return getattr(self._wrapped, n)
 
 
+class CudaGraphModel(object):
+    """
+    Captures the forward pass of the model for a fixed batch size in a cuda graph and replays it for every batch of
+    that size (no per-kernel launch overhead), batches of other sizes (e.g. the last one) run the model directly.
+
+    The outputs of a replay are static tensors which are overwritten by the next replay.
+    """
+
+    def __init__(self, model, input_shape, autocast_dtype, use_autocast, warmup_iterations=3):
+        self.model = model
+        self.static_input = torch.zeros(input_shape, device="cuda").contiguous(memory_format=torch.channels_last)
+
+        # the graph records the kernels of the casted model, caching of casted weights is not allowed while capturing
+        autocast = torch.autocast(device_type='cuda', dtype=autocast_dtype, enabled=use_autocast, cache_enabled=False)
+
+        with torch.no_grad(), autocast:
+            # warmup on a side stream (as required before capturing)
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(warmup_iterations):
+                    self.model(self.static_input)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self.static_output = self.model(self.static_input)
+
+    def __call__(self, input):
+        if input.shape != self.static_input.shape:
+            return self.model(input)
+
+        self.static_input.copy_(input, non_blocking=True)
+        self.graph.replay()
+        return self.static_output
+
+
 class Prediction(object):
 
     def __init__(self, engine, device):
@@ -56,21 +96,58 @@ class Prediction(object):
 
         return cfg
 
+    def get_inference_model(self):
+        """
+        Scripts and freezes the model, this inlines parameters as constants and removes training-only code. Batch
+        norms directly following a convolution (backbone, deconv decoder) are folded into it, the batch norms of the
+        pixelshuffle decoder are not (the PixelShuffle sits between convolution and batch norm). Falls back to the
+        eager model if the model can not be scripted.
+
+        Returns: model for inference
+
+        """
+        model = self.engine.model.eval()
+        try:
+            frozen = torch.jit.freeze(torch.jit.script(model))
+            frozen = torch.jit.optimize_for_inference(frozen)
+        except (RuntimeError, torch.jit.frontend.NotSupportedError) as e:
+            Logcreator.warn("Model could not be scripted, using the eager model for inference:", e)
+            return model
+
+        Logcreator.info("Using the scripted and frozen model for inference")
+        return frozen
+
     def predict(self):
         cfg = self.get_dataset_config()
 
         test_dataset = DataSetFactory.load(cfg, is_train=False)
 
+        # more workers than cpus only adds scheduling overhead
+        num_workers = min(Configuration.get("training.general.num_workers"), os.cpu_count() or 1)
+        # prefetch more batches to overlap image decoding with the forward pass (only possible with worker processes)
+        worker_kwargs = {'persistent_workers': True, 'prefetch_factor': 4} if num_workers > 0 else {}
+
         test_loader = torch.utils.data.DataLoader(
             test_dataset,
             batch_size=Configuration.get("training.general.batch_size"),  # * len(gpus)
             shuffle=False,
-            num_workers=Configuration.get("training.general.num_workers"),
-            pin_memory=True
+            num_workers=num_workers,
+            pin_memory=True,
+            drop_last=False,  # every test sample is predicted, the partial last batch runs outside the cuda graph
+            **worker_kwargs
         )
 
+        model = self.get_inference_model()
+        if self.device == "cuda":
+            model = CudaGraphModel(model,
+                                   input_shape=(test_loader.batch_size, 3, self.engine.patch_height,
+                                                self.engine.patch_width),
+                                   autocast_dtype=self.engine.amp_dtype,
+                                   use_autocast=self.engine.use_amp)
+
         # run validate and evaluate with test set
-        val_loss, preds_in_patch_with_score = self.engine.validate(test_loader, epoch=0, only_prediction=True)
+        val_loss, preds_in_patch_with_score = self.engine.validate(test_loader, epoch=0, only_prediction=True,
+                                                                   model=model)
         acc = self.engine.evaluate(0, preds_in_patch_with_score, test_loader, Configuration.output_directory,
                                    debug=False,
                                    writer_dict=None)